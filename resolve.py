@@ -3,11 +3,23 @@ resolve.py: a recursive resolver built using dnspython
 """
 
 import argparse
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import math
+import os
+import pickle
 import time
+from collections import OrderedDict
 
+import dns.asyncquery
+import dns.exception
+import dns.flags
 import dns.message
 import dns.name
-import dns.query
+import dns.rcode
 import dns.rdata
 import dns.rdataclass
 import dns.rdatatype
@@ -17,6 +29,10 @@ FORMATS = (("CNAME", "{alias} is an alias for {name}"),
            ("AAAA", "{name} has IPv6 address {address}"),
            ("MX", "{name} mail is handled by {preference} {exchange}"))
 
+# FORMATS with each format string's bound format_map, so print_results can
+# format a record dict directly instead of unpacking it into keyword arguments
+FORMATTERS = tuple((rtype, fmt_str.format_map) for rtype, fmt_str in FORMATS)
+
 # current as of 25 October 2018
 ROOT_SERVERS = ("198.41.0.4",
                 "199.9.14.201",
@@ -32,295 +48,712 @@ ROOT_SERVERS = ("198.41.0.4",
                 "199.7.83.42",
                 "202.12.27.33")
 
+# Maximum number of entries kept in each cache before evicting the least
+# recently used, and the TTL used for responses without any answer records
+MAX_CACHE_ENTRIES = 10000
+DEFAULT_TTL = 60
+
+class LRU(OrderedDict):
+    """
+    An OrderedDict that holds at most `maxsize` entries. Reading or storing an
+    entry with [] makes it the most recently used; storing past `maxsize`
+    evicts the least recently used. .get() and iteration don't go through
+    __getitem__, so they leave the order alone (RTT is read with .get, so
+    servers are kept by when they were last measured, not last looked at).
+    """
+
+    def __init__(self, maxsize: int = MAX_CACHE_ENTRIES):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
 # A global cache to store responses.
 # The key will be a tuple: (dns.name.Name, dns.rdatatype)
-# The value will be the dns.message.Message response.
-CACHE = {}
+# The value will be a tuple: (expiry time from time.monotonic(), dns.message.Message)
+# Use _cache_get/_cache_put rather than touching it directly.
+CACHE = LRU(MAX_CACHE_ENTRIES)
+
+# Negative answers (NXDOMAIN, or NODATA indicated by an SOA), stored like CACHE
+# but kept only for the negative TTL given by their SOA record (RFC 2308).
+NEG_CACHE = LRU(MAX_CACHE_ENTRIES)
 
-# Track what we're currently resolving to prevent infinite loops
-RESOLVING = set()
+# Track which lookups the current resolution is nested inside (the INFLIGHT
+# entries it owns) to prevent infinite loops. This is per task, so concurrent
+# lookups don't block each other.
+RESOLVING = contextvars.ContextVar("RESOLVING", default=frozenset())
+
+# Lookups currently in progress, so concurrent callers asking the same question
+# wait for one resolution instead of repeating it.
+# The key is the same as for CACHE; the value is an asyncio.Future for the response.
+INFLIGHT = {}
+
+# For each INFLIGHT lookup whose task is waiting on another INFLIGHT lookup, the
+# key of the one it waits for, so that lookups never end up waiting on each other
+WAITING_ON = {}
 
 # Cache for delegations (intermediate results): map zone name -> list of IPv4 NS IPs
 # Example: dns.name.from_text('edu.') -> ['192.5.6.30', ...]
-DELEGATION_CACHE = {}
+# Entries are stored with an expiry like CACHE, using the TTL of the NS rrset.
+DELEGATION_CACHE = LRU(MAX_CACHE_ENTRIES)
+
+# Where the caches are saved between runs, and how long an entry must still
+# have to live for it to be worth saving
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "resolve.pkl")
+SAVE_MARGIN = 60
+
+# How many servers may be queried at once for a single referral level, and how
+# long to wait on the outstanding queries before bringing in another server
+MAX_PARALLEL = 3
+STAGGER_DELAY = 0.1
+
+# Smoothed response time in seconds of each server we have queried, used to
+# try the quickest servers first. Servers that time out are given RTT_PENALTY;
+# ones we have never queried are assumed to take RTT_UNKNOWN.
+RTT = LRU(MAX_CACHE_ENTRIES)
+RTT_PENALTY = 5.0
+RTT_UNKNOWN = 0.1
+
+# UDP payload size advertised with EDNS0, so that most answers fit in a single
+# datagram instead of coming back truncated (the limit without EDNS is 512 bytes)
+EDNS_PAYLOAD = 4096
+
+# Rcodes a server without EDNS support may answer an EDNS0 query with; the
+# query is then repeated to that server without EDNS
+EDNS_ERRORS = (dns.rcode.FORMERR, dns.rcode.NOTIMP, dns.rcode.BADVERS)
+
+# Seconds a whole lookup may take, across all referrals and servers, before
+# giving up; individual queries still time out after 3 seconds. Going through
+# every root server MAX_PARALLEL at a time, each timing out, takes
+# ceil(13 / 3) * 3 = 15 seconds, so allow twice that to leave as much again
+# for the referrals below the root.
+LOOKUP_LIFETIME = 2 * math.ceil(len(ROOT_SERVERS) / MAX_PARALLEL) * 3.0
 
-def collect_results(name: str) -> dict:
+def _ttl_get(cache: LRU, key):
+    """
+    Return the value stored under `key` in `cache`, or None if there is
+    none or it has expired.
+    """
+    try:
+        expiry, value = cache[key]
+    except KeyError:
+        return None
+    if time.monotonic() >= expiry:
+        del cache[key]
+        return None
+    return value
+
+def _ttl_put(cache: LRU, key, value, ttl: float) -> None:
+    """
+    Store `value` under `key` in `cache` for `ttl` seconds.
+    """
+    cache[key] = (time.monotonic() + ttl, value)
+
+def _negative_ttl(response: dns.message.Message):
+    """
+    Return how long a negative `response` may be cached: the lower of its
+    SOA record's TTL and MINIMUM field. None if it carries no SOA.
+    """
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+def _cache_get(key) -> dns.message.Message:
+    """
+    Return the cached response for `key`, positive or negative, or None if it
+    is missing or stale.
+    """
+    response = _ttl_get(CACHE, key)
+    if response is None:
+        response = _ttl_get(NEG_CACHE, key)
+    return response
+
+def _cache_put(key, response: dns.message.Message) -> None:
+    """
+    Cache `response` under `key` for the lowest TTL among its answers, or in
+    NEG_CACHE for its negative TTL if it has no answers but carries an SOA.
+    Error responses other than NXDOMAIN (SERVFAIL, REFUSED, ...) describe one
+    server rather than the name, so they are not cached at all.
+    """
+    if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        return
+    if not response.answer:
+        neg_ttl = _negative_ttl(response)
+        if neg_ttl is not None:
+            CACHE.pop(key, None)
+            _ttl_put(NEG_CACHE, key, response, neg_ttl)
+            return
+    NEG_CACHE.pop(key, None)
+    ttl = min((rrset.ttl for rrset in response.answer), default=DEFAULT_TTL)
+    _ttl_put(CACHE, key, response, ttl)
+
+def _persisted_caches() -> dict:
+    """
+    The caches saved to CACHE_FILE, by name.
+    """
+    return {"CACHE": CACHE,
+            "NEG_CACHE": NEG_CACHE,
+            "DELEGATION_CACHE": DELEGATION_CACHE}
+
+def _valid_entry(cache_name: str, key, value) -> bool:
+    """
+    Whether `key` and `value` have the shape the cache `cache_name` holds, so
+    a damaged CACHE_FILE can't put anything else in the caches.
+    """
+    if cache_name == "DELEGATION_CACHE":
+        return (isinstance(key, dns.name.Name) and isinstance(value, list)
+                and all(isinstance(server_ip, str) for server_ip in value))
+    return (isinstance(key, tuple) and len(key) == 2
+            and isinstance(key[0], dns.name.Name) and isinstance(key[1], int)
+            and isinstance(value, dns.message.Message))
+
+def _load_caches() -> None:
+    """
+    Fill the caches and RTT from CACHE_FILE, skipping entries that have expired
+    since they were saved. A missing, unreadable or malformed file leaves them
+    as they are.
+    """
+    # Expiry times are saved as wall clock times, since time.monotonic()
+    # values mean nothing to another process
+    now = time.monotonic()
+    offset = now - time.time()
+    try:
+        with open(CACHE_FILE, "rb") as cache_file:
+            saved = pickle.load(cache_file)
+        loaded = {}
+        for cache_name in _persisted_caches():
+            loaded[cache_name] = []
+            for key, (expiry, value) in saved.get(cache_name, {}).items():
+                if not _valid_entry(cache_name, key, value):
+                    raise TypeError(f"bad {cache_name} entry for {key!r}")
+                expiry = float(expiry) + offset
+                if expiry > now:
+                    loaded[cache_name].append((key, (expiry, value)))
+        rtt = {}
+        for server_ip, server_rtt in saved.get("RTT", {}).items():
+            if not isinstance(server_ip, str):
+                raise TypeError(f"bad RTT entry for {server_ip!r}")
+            rtt[server_ip] = float(server_rtt)
+    except Exception:
+        return
+
+    for cache_name, cache in _persisted_caches().items():
+        for key, entry in loaded[cache_name]:
+            cache[key] = entry
+    RTT.update(rtt)
+
+def _save_caches() -> None:
+    """
+    Write the caches and RTT to CACHE_FILE, leaving out cache entries due to
+    expire within SAVE_MARGIN seconds. The file is replaced in one step, so an
+    interrupted save never leaves a half-written cache behind.
+    """
+    now = time.monotonic()
+    offset = time.time() - now
+    saved = {}
+    for cache_name, cache in _persisted_caches().items():
+        saved[cache_name] = {key: (expiry + offset, value)
+                             for key, (expiry, value) in cache.items()
+                             if expiry > now + SAVE_MARGIN}
+    saved["RTT"] = dict(RTT)
+    temp_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(temp_file, "wb") as cache_file:
+            pickle.dump(saved, cache_file)
+        os.replace(temp_file, CACHE_FILE)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+
+def _handle_cname(rrset, results: dict) -> None:
+    """
+    Add the alias in a CNAME rrset to `results`.
+    """
+    for answer in rrset:
+        results["CNAME"].append({"name": answer.target.to_text(),
+                                 "alias": rrset.name.to_text()})
+
+def _handle_a(rrset, results: dict) -> None:
+    """
+    Add the addresses in an A rrset to `results`.
+    """
+    for answer in rrset:
+        results["A"].append({"name": rrset.name, "address": answer.address})
+
+def _handle_aaaa(rrset, results: dict) -> None:
+    """
+    Add the addresses in an AAAA rrset to `results`.
+    """
+    for answer in rrset:
+        results["AAAA"].append({"name": rrset.name, "address": answer.address})
+
+def _handle_mx(rrset, results: dict) -> None:
+    """
+    Add the mail exchangers in an MX rrset to `results`.
+    """
+    for answer in rrset:
+        results["MX"].append({"name": rrset.name,
+                              "preference": answer.preference,
+                              "exchange": answer.exchange.to_text()})
+
+# How collect_results turns each type of answer rrset into print_results records
+ANSWER_HANDLERS = {dns.rdatatype.CNAME: _handle_cname,
+                   dns.rdatatype.A: _handle_a,
+                   dns.rdatatype.AAAA: _handle_aaaa,
+                   dns.rdatatype.MX: _handle_mx}
+
+async def collect_results(name: str) -> dict:
     """
     This function parses final answers into the proper data structure that
-    print_results requires. The main work is done within the `lookup` function.
+    print_results requires. The main work is done within the `async_lookup`
+    function; once the name's zone is known, the AAAA and MX lookups run
+    concurrently against its nameservers, unless the A lookup already showed
+    that the name doesn't exist or that no server would answer for it.
     """
-    full_response = {}
     target_name = dns.name.from_text(name)
     
-    # lookup A - this will follow CNAMEs and return the full chain
-    response = lookup(target_name, dns.rdatatype.A)
+    # A walks down to the zone first, following CNAMEs and returning the full
+    # chain, so AAAA and MX can start at the nameservers it leaves cached
+    a_response = await async_lookup(target_name, dns.rdatatype.A)
+    if a_response.rcode() in (dns.rcode.NXDOMAIN, dns.rcode.SERVFAIL):
+        # The name doesn't exist, so it has no records of any type (RFC 8020),
+        # or A ran out of servers or time, and AAAA and MX would only wait on
+        # the same dead servers again
+        aaaa_response = mx_response = a_response
+    else:
+        aaaa_response, mx_response = await asyncio.gather(
+            async_lookup(target_name, dns.rdatatype.AAAA),
+            async_lookup(target_name, dns.rdatatype.MX))
     
-    # Collect ALL CNAMEs from the answer (the full CNAME chain)
-    cnames = []
-    current_name = name
-    arecords = []
-    
-    for rrset in response.answer:
-        if rrset.rdtype == dns.rdatatype.CNAME:
-            # This is a CNAME record
-            for answer in rrset:
-                cnames.append({"name": str(answer), "alias": current_name})
-                current_name = str(answer)
-        elif rrset.rdtype == 1:  # A record
-            a_name = rrset.name
-            for answer in rrset:
-                arecords.append({"name": a_name, "address": str(answer)})
-    
-    # lookup AAAA
-    response = lookup(target_name, dns.rdatatype.AAAA)
-    aaaarecords = []
-    for answers in response.answer:
-        aaaa_name = answers.name
-        for answer in answers:
-            if answer.rdtype == 28:  # AAAA record
-                aaaarecords.append({"name": aaaa_name, "address": str(answer)})
-    # lookup MX
-    response = lookup(target_name, dns.rdatatype.MX)
-    mxrecords = []
-    for answers in response.answer:
-        mx_name = answers.name
-        for answer in answers:
-            if answer.rdtype == 15:  # MX record
-                mxrecords.append({"name": mx_name,
-                                  "preference": answer.preference,
-                                  "exchange": str(answer.exchange)})
-
-    full_response["CNAME"] = cnames
-    full_response["A"] = arecords
-    full_response["AAAA"] = aaaarecords
-    full_response["MX"] = mxrecords
+    # One pass over every answer rrset, skipping the ones seen in an earlier
+    # response (AAAA and MX repeat the CNAME chain found by A)
+    full_response = {rtype: [] for rtype, _ in FORMATS}
+    seen = set()
+    for response in (a_response, aaaa_response, mx_response):
+        for rrset in response.answer:
+            handler = ANSWER_HANDLERS.get(rrset.rdtype)
+            if handler is None or (rrset.name, rrset.rdtype) in seen:
+                continue
+            seen.add((rrset.name, rrset.rdtype))
+            handler(rrset, full_response)
+
+    # Show the start of the CNAME chain as the name was given, like host does
+    if full_response["CNAME"]:
+        full_response["CNAME"][0]["alias"] = name
 
     return full_response
 
-def _lookup_recursive(target_name: dns.name.Name, qtype: int, nameservers: list) -> dns.message.Message:
+async def _async_query(query: dns.message.Message, server_ip: str, deadline: float) -> dns.message.Message:
+    """
+    Send `query` to `server_ip` over UDP, repeating it without EDNS if the
+    server rejects EDNS0, and over TCP if the answer came back truncated.
+    Each attempt times out after 3 seconds or at `deadline`, whichever comes
+    first. The UDP round trip is recorded in RTT if the reply is usable;
+    servers that fail or answer with an error are given RTT_PENALTY instead.
+    """
+    start = time.monotonic()
+    timeout = min(3.0, deadline - start)
+    try:
+        # A new socket per query, so each one goes out from its own random
+        # source port; a single shared socket would make replies easier to spoof
+        response = await dns.asyncquery.udp(query, server_ip, timeout=timeout)
+        if response.rcode() in EDNS_ERRORS and query.edns >= 0:
+            # Likely a server that predates EDNS0, so ask it again without
+            query = dns.message.make_query(query.question[0].name, query.question[0].rdtype)
+            timeout = min(3.0, deadline - time.monotonic())
+            response = await dns.asyncquery.udp(query, server_ip, timeout=timeout)
+    except dns.exception.Timeout:
+        # Only blame the server if it had the full 3 seconds to answer, not
+        # when the deadline cut its timeout short
+        if timeout >= 3.0:
+            RTT[server_ip] = RTT_PENALTY
+        raise
+    except OSError:
+        RTT[server_ip] = RTT_PENALTY
+        raise
+    elapsed = time.monotonic() - start
+    if _is_usable(response):
+        RTT[server_ip] = 0.8 * RTT.get(server_ip, elapsed) + 0.2 * elapsed
+    else:
+        # A server that fails instantly must not sort ahead of working ones
+        RTT[server_ip] = RTT_PENALTY
+
+    if response.flags & dns.flags.TC:
+        timeout = min(3.0, deadline - time.monotonic())
+        response = await dns.asyncquery.tcp(query, server_ip, timeout=timeout)
+    return response
+
+def _is_usable(response: dns.message.Message) -> bool:
+    """
+    Whether `response` can be acted on: NOERROR, or NXDOMAIN from a server
+    authoritative for the name. Anything else (SERVFAIL, REFUSED, FORMERR, or
+    a non-authoritative NXDOMAIN) only says something about that server.
+    """
+    rcode = response.rcode()
+    if rcode == dns.rcode.NOERROR:
+        return True
+    return rcode == dns.rcode.NXDOMAIN and bool(response.flags & dns.flags.AA)
+
+async def _async_query_servers(query: dns.message.Message, nameservers: list, deadline: float):
+    """
+    Send `query` to the IPv4 servers in `nameservers` and yield each usable
+    response as it arrives; error responses count as failures, like timeouts.
+    Up to MAX_PARALLEL queries are kept in flight; a new server is only added
+    once the outstanding ones have been quiet for STAGGER_DELAY seconds (or
+    have failed), so a healthy first server is usually the only one asked. Servers are tried in order of their measured RTT. Every server
+    is still tried at most once, and no query is sent or waited on past
+    `deadline` (a time.monotonic() value).
+    """
+    # Skip duplicates and anything that isn't an IPv4 literal, then order the
+    # servers fastest first (popped from the end)
+    seen = set()
+    servers = []
+    for server_ip in nameservers:
+        if server_ip in seen or ':' in server_ip:
+            continue
+        seen.add(server_ip)
+        servers.append(server_ip)
+    servers.sort(key=lambda server_ip: RTT.get(server_ip, RTT_UNKNOWN))
+    servers.reverse()
+    pending = set()
+    try:
+        while servers or pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if servers and len(pending) < MAX_PARALLEL:
+                pending.add(asyncio.ensure_future(
+                    _async_query(query, servers.pop(), deadline)))
+            # Only wait the stagger delay if there is another server to bring in
+            timeout = STAGGER_DELAY if servers and len(pending) < MAX_PARALLEL else None
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    response = task.result()
+                except (dns.exception.Timeout, OSError):
+                    continue
+                except Exception:
+                    continue
+                if not _is_usable(response):
+                    continue
+                yield response
+    finally:
+        for task in pending:
+            task.cancel()
+
+@functools.lru_cache(maxsize=4096)
+def _ancestors(name: dns.name.Name) -> tuple:
+    """
+    Return `name` and each of its parent zones, closest first, stopping
+    before the root (e.g. www.uic.edu., uic.edu., edu.).
+    """
+    return tuple(dns.name.Name(name.labels[i:]) for i in range(len(name.labels) - 1))
+
+def _closest_delegation(name: dns.name.Name) -> tuple:
+    """
+    Return the closest ancestor zone of `name` that we have a cached delegation
+    for and its nameserver IPs, or the root zone and the root servers if there
+    is none.
+    """
+    for zone in _ancestors(name):
+        servers = _ttl_get(DELEGATION_CACHE, zone)
+        if servers:
+            return zone, servers
+    return dns.name.root, list(ROOT_SERVERS)
+
+async def _async_lookup_shared(target_name: dns.name.Name, qtype: int, nameservers: list,
+                               deadline: float = None,
+                               zone: dns.name.Name = dns.name.root) -> dns.message.Message:
+    """
+    Resolve `target_name` starting from `nameservers` like
+    `_async_lookup_recursive`, but if the same query is already being resolved
+    elsewhere, wait for that result instead of sending our own queries.
+    Returns None if that would mean waiting on ourselves.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + LOOKUP_LIFETIME
+    cache_key = (target_name, qtype)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+    resolving = RESOLVING.get()
+    if cache_key in resolving:
+        # We are already resolving this further up, e.g. a zone whose only
+        # nameserver is an unglued name inside the zone itself
+        return None
+    if cache_key in INFLIGHT:
+        if _waits_on(cache_key, resolving):
+            # Its owner is waiting on us, so neither would finish before the deadline
+            return None
+        for key in resolving:
+            WAITING_ON[key] = cache_key
+        try:
+            return await asyncio.wait_for(asyncio.shield(INFLIGHT[cache_key]),
+                                          deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            for key in resolving:
+                del WAITING_ON[key]
+
+    future = asyncio.get_running_loop().create_future()
+    INFLIGHT[cache_key] = future
+    token = RESOLVING.set(resolving | {cache_key})
+    response = None
+    try:
+        response = await _async_lookup_recursive(target_name, qtype, nameservers, deadline, zone=zone)
+    finally:
+        # Waiters get None (a failed lookup) if we were cancelled or raised
+        RESOLVING.reset(token)
+        del INFLIGHT[cache_key]
+        future.set_result(response)
+    return response
+
+def _waits_on(cache_key: tuple, resolving: frozenset) -> bool:
+    """
+    Whether the INFLIGHT lookup for `cache_key` is waiting, directly or through
+    other lookups, on one of the lookups in `resolving`.
+    """
+    seen = set()
+    while cache_key is not None and cache_key not in seen:
+        if cache_key in resolving:
+            return True
+        seen.add(cache_key)
+        cache_key = WAITING_ON.get(cache_key)
+    return False
+
+async def _async_lookup_recursive(target_name: dns.name.Name, qtype: int, nameservers: list,
+                                  deadline: float = None,
+                                  query: dns.message.Message = None,
+                                  zone: dns.name.Name = dns.name.root) -> dns.message.Message:
     """
     A helper function that recursively queries nameservers.
-    It exhaustively tries all servers in the `nameservers` list.
+    It exhaustively tries all servers in the `nameservers` list, giving up
+    once `deadline` (a time.monotonic() value) has passed. `query` is the
+    message to send, if the caller already built one for this question.
+    `zone` is the zone `nameservers` serve.
     """
-    global CACHE, RESOLVING
+    if deadline is None:
+        deadline = time.monotonic() + LOOKUP_LIFETIME
     
     # Check cache first for this exact query
     cache_key = (target_name, qtype)
-    if cache_key in CACHE:
-        return CACHE[cache_key]
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+    if time.monotonic() >= deadline:
+        return None
     
-    query = dns.message.make_query(target_name, qtype)
+    if query is None:
+        query = dns.message.make_query(target_name, qtype, use_edns=0, payload=EDNS_PAYLOAD)
 
-    # Iterate through all provided servers exhaustively
-    for _, server_ip in enumerate(dict.fromkeys(nameservers)):
-        # Ensure we only try IPv4 literals (skip anything else just in case)
-        if ':' in server_ip:
-            continue
-        
-        try:
-            # Use a 3-second timeout as required
-            response = dns.query.udp(query, server_ip, timeout=3.0)
-
-            # Case 1: We got a final positive answer. Cache it and return.
-            if response.answer:
-                CACHE[cache_key] = response
-                return response
-
-            # Case 1b: Negative response (NXDOMAIN or NODATA indicated by SOA)
-            if response.rcode() != dns.rcode.NOERROR:
-                CACHE[cache_key] = response
-                return response
-
-            # NODATA typically includes an SOA in authority, treat as final
-            has_soa = any(rrset.rdtype == dns.rdatatype.SOA for rrset in response.authority)
-            if has_soa:
-                CACHE[cache_key] = response
-                return response
-
-            # Case 2: We got a referral.
-            if response.authority:
-                # Get the names of the next-level servers from the authority section.
-                ns_names = []
-                zone_name = None
-                for rrset in response.authority:
-                    if rrset.rdtype == dns.rdatatype.NS:
-                        # This rrset.name is the zone being delegated (e.g., 'edu.')
-                        zone_name = rrset.name
-                        for rr in rrset:
-                            ns_names.append(str(rr.target).rstrip('.'))
-
-                if not ns_names:
-                    # No NS in authority and no answer: nothing further to do
-                    CACHE[cache_key] = response
+    # Query all provided servers exhaustively, handling responses as they arrive
+    async with contextlib.aclosing(_async_query_servers(query, nameservers, deadline)) as responses:
+        async for response in responses:
+            try:
+                # Case 1: We got a final positive answer. Cache it and return.
+                if response.answer:
+                    _cache_put(cache_key, response)
+                    # Remember each alias on its own for lookups of other types,
+                    # but only those the servers are authoritative for
+                    for rrset in response.answer:
+                        if rrset.rdtype == dns.rdatatype.CNAME and rrset.name.is_subdomain(zone):
+                            _cache_put((rrset.name, dns.rdatatype.CNAME),
+                                       _build_final(rrset.name, dns.rdatatype.CNAME, [rrset]))
                     return response
 
-                # Get the IPs (glue) for these servers from the additional section.
-                next_server_ips = []
-                for rrset in response.additional:
-                    if rrset.rdtype == dns.rdatatype.A:
-                        next_server_ips.append(str(rrset[0]))
+                # Case 1b: Negative response (NXDOMAIN or NODATA indicated by SOA)
+                if response.rcode() != dns.rcode.NOERROR:
+                    _cache_put(cache_key, response)
+                    return response
+
+                # NODATA typically includes an SOA in authority, treat as final
+                has_soa = any(rrset.rdtype == dns.rdatatype.SOA for rrset in response.authority)
+                if has_soa:
+                    _cache_put(cache_key, response)
+                    return response
+
+                # Case 2: We got a referral.
+                if response.authority:
+                    # Get the names of the next-level servers from the authority section.
+                    ns_names = []
+                    zone_name = None
+                    for rrset in response.authority:
+                        if rrset.rdtype == dns.rdatatype.NS:
+                            # This rrset.name is the zone being delegated (e.g., 'edu.')
+                            zone_name = rrset.name
+                            zone_ttl = rrset.ttl
+                            for rr in rrset:
+                                ns_names.append(rr.target)
+
+                    if not ns_names:
+                        # No NS in authority and no answer: nothing further to do
+                        _cache_put(cache_key, response)
+                        return response
+
+                    # Get the IPs (glue) for these servers from the additional section.
+                    next_server_ips = []
+                    for rrset in response.additional:
+                        if rrset.rdtype == dns.rdatatype.A:
+                            next_server_ips.append(rrset[0].address)
                 
-                # If we have glue records, use them
-                if next_server_ips:
-                    # Cache delegation for the zone if known
-                    if zone_name is not None:
-                        DELEGATION_CACHE[zone_name] = list(dict.fromkeys(next_server_ips))
-                    recursive_response = _lookup_recursive(target_name, qtype, next_server_ips)
-                    if recursive_response:
-                        return recursive_response
-                else:
-                    # Unglued case: need to resolve NS names to IPs (try all NS names)
-                    collected_limit = 3  # resolve a few NS names to get started faster
-                    for ns_idx, ns_name in enumerate(ns_names):
-                        ns_dns_name = dns.name.from_text(ns_name)
-                        
-                        # Avoid infinite loops
-                        if (ns_dns_name, dns.rdatatype.A) in RESOLVING:
-                            continue
-                        
-                        # Check cache first
-                        ns_cache_key = (ns_dns_name, dns.rdatatype.A)
-                        if ns_cache_key in CACHE:
-                            ns_response = CACHE[ns_cache_key]
-                        else:
-                            # Mark as resolving
-                            RESOLVING.add(ns_cache_key)
-                            try:
-                                ns_response = _lookup_recursive(ns_dns_name, dns.rdatatype.A, list(ROOT_SERVERS))
-                            finally:
-                                RESOLVING.discard(ns_cache_key)
-                        
-                        if ns_response and ns_response.answer:
-                            for rrset in ns_response.answer:
-                                if rrset.rdtype == dns.rdatatype.A:
-                                    for rr in rrset:
-                                        next_server_ips.append(str(rr))
-                        # If we have collected enough IPs, move on to query them
-                        if len(next_server_ips) >= collected_limit:
-                            break
-                    # Deduplicate and cache delegation if we discovered IPs
+                    # If we have glue records, use them
                     if next_server_ips:
-                        next_server_ips = list(dict.fromkeys(ip for ip in next_server_ips if ':' not in ip))
+                        # Cache delegation for the zone if known
                         if zone_name is not None:
-                            DELEGATION_CACHE[zone_name] = next_server_ips
-                    
-                    if next_server_ips:
-                        recursive_response = _lookup_recursive(target_name, qtype, next_server_ips)
+                            _ttl_put(DELEGATION_CACHE, zone_name, list(dict.fromkeys(next_server_ips)), zone_ttl)
+                        recursive_response = await _async_lookup_recursive(target_name, qtype, next_server_ips, deadline, query, zone_name)
                         if recursive_response:
                             return recursive_response
-            
-        except (dns.exception.Timeout, OSError):
-            continue
-        except Exception:
-            continue
+                    else:
+                        # Unglued case: need to resolve NS names to IPs (try all NS names)
+                        collected_limit = 3  # resolve a few NS names to get started faster
+                        for ns_idx, ns_name in enumerate(ns_names):
+                            # Avoid infinite loops
+                            ns_cache_key = (ns_name, dns.rdatatype.A)
+                            if ns_cache_key in RESOLVING.get():
+                                continue
+                        
+                            ns_response = await _async_lookup_shared(ns_name, dns.rdatatype.A, list(ROOT_SERVERS), deadline)
+                        
+                            if ns_response and ns_response.answer:
+                                for rrset in ns_response.answer:
+                                    if rrset.rdtype == dns.rdatatype.A:
+                                        for rr in rrset:
+                                            next_server_ips.append(rr.address)
+                            # If we have collected enough IPs, move on to query them
+                            if len(next_server_ips) >= collected_limit:
+                                break
+                        # Deduplicate and cache delegation if we discovered IPs
+                        if next_server_ips:
+                            next_server_ips = list(dict.fromkeys(ip for ip in next_server_ips if ':' not in ip))
+                            if zone_name is not None:
+                                _ttl_put(DELEGATION_CACHE, zone_name, next_server_ips, zone_ttl)
+                    
+                        if next_server_ips:
+                            recursive_response = await _async_lookup_recursive(target_name, qtype, next_server_ips, deadline, query, zone_name)
+                            if recursive_response:
+                                return recursive_response
+
+            except (dns.exception.Timeout, OSError):
+                continue
+            except Exception:
+                continue
 
     return None
 
-def lookup(target_name: dns.name.Name,
-           qtype: int) -> dns.message.Message:
+def _build_final(target_name: dns.name.Name, qtype: int, answers: list) -> dns.message.Message:
+    """
+    Build the response `async_lookup` returns for `target_name`: a reply to
+    the original question holding every rrset in `answers`.
+    """
+    response = dns.message.make_response(dns.message.make_query(target_name, qtype))
+    response.answer.extend(answers)
+    return response
+
+def _is_complete(response: dns.message.Message, qtype: int) -> bool:
+    """
+    Whether `response` is a final answer for `qtype`, rather than one that
+    stops at a CNAME still to be followed. _async_lookup_recursive caches the
+    latter under the alias's own key when a chain from another name passes
+    through it.
+    """
+    if qtype == dns.rdatatype.CNAME:
+        return True
+    if any(rrset.rdtype == qtype for rrset in response.answer):
+        return True
+    return not any(rrset.rdtype == dns.rdatatype.CNAME for rrset in response.answer)
+
+async def async_lookup(target_name: dns.name.Name,
+                       qtype: int,
+                       deadline: float = None) -> dns.message.Message:
     """
     This function uses a recursive resolver to find the relevant answer to the
-    query.
+    query. It gives up once `deadline` (a time.monotonic() value, by default
+    LOOKUP_LIFETIME seconds from now) has passed.
 
     TODO: replace this implementation with one which asks the root servers
     and recurses to find the proper answer.
     """
-    global CACHE
     
+    if deadline is None:
+        deadline = time.monotonic() + LOOKUP_LIFETIME
     original_target = target_name
     original_qtype = qtype
     
     # Check cache at the very beginning
     cache_key = (target_name, qtype)
-    if cache_key in CACHE:
-        return CACHE[cache_key]
+    cached = _cache_get(cache_key)
+    if cached is not None and _is_complete(cached, qtype):
+        return cached
 
     # Accumulate all answer sections (to capture full CNAME chain)
     all_answers = []
+    response = None
     
     # Loop to handle CNAME restarts
     cname_chain_count = 0
     while cname_chain_count < 10:  # Prevent infinite CNAME loops
-        # Start the recursive lookup process using best-known delegation if available
-        # Find closest ancestor zone we have cached
-        start_servers = None
-        current = target_name
-        while True:
-            if current in DELEGATION_CACHE and DELEGATION_CACHE[current]:
-                start_servers = DELEGATION_CACHE[current]
-                break
-            if len(current.labels) <= 1:  # reached root
-                break
-            current = current.parent()
-        if not start_servers:
-            start_servers = list(ROOT_SERVERS)
-
-        response = _lookup_recursive(target_name, qtype, start_servers)
+        # An alias already seen for this name (e.g. by the A lookup) holds for
+        # every type, so follow it without asking again
+        response = None
+        if qtype != dns.rdatatype.CNAME:
+            response = _cache_get((target_name, dns.rdatatype.CNAME))
+        if response is None:
+            # Start the recursive lookup process using best-known delegation if available.
+            # DELEGATION_CACHE holds every zone passed through so far, so a CNAME
+            # target in the same zone goes straight back to the same servers.
+            start_zone, start_servers = _closest_delegation(target_name)
+            response = await _async_lookup_shared(target_name, qtype, start_servers, deadline, start_zone)
         
         # If the lookup failed completely, return what we have or empty
         if not response or not response.answer:
-            if all_answers:
-                # We have some answers from previous CNAME lookups
-                query = dns.message.make_query(original_target, original_qtype)
-                final_response = dns.message.make_response(query)
-                for ans in all_answers:
-                    final_response.answer.append(ans)
-                CACHE[(original_target, original_qtype)] = final_response
-                return final_response
-            query = dns.message.make_query(original_target, original_qtype)
-            empty_response = dns.message.make_response(query)
-            result = empty_response if response is None else response
-            CACHE[(original_target, original_qtype)] = result
-            return result
+            break
 
         # Add current response answers to our accumulator
-        for ans in response.answer:
-            all_answers.append(ans)
+        all_answers.extend(response.answer)
 
         # Check the answer section for the record type we want.
-        found_final_answer = False
-        for rrset in response.answer:
-            if rrset.rdtype == qtype:
-                found_final_answer = True
-                break
-        
-        if found_final_answer:
-            # Build final response with all accumulated answers
-            query = dns.message.make_query(original_target, original_qtype)
-            final_response = dns.message.make_response(query)
-            for ans in all_answers:
-                final_response.answer.append(ans)
-            CACHE[(original_target, original_qtype)] = final_response
-            return final_response
+        if any(rrset.rdtype == qtype for rrset in response.answer):
+            break
         
         # Check for a CNAME instead.
         found_cname = False
         for rrset in response.answer:
             if rrset.rdtype == dns.rdatatype.CNAME:
-                new_name_str = str(rrset[0])
-                target_name = dns.name.from_text(new_name_str)
+                target_name = rrset[0].target
                 found_cname = True
                 cname_chain_count += 1
                 break
         
-        if found_cname:
-            continue
-        
         # If we got an answer but it's neither what we asked for nor a CNAME
-        query = dns.message.make_query(original_target, original_qtype)
-        final_response = dns.message.make_response(query)
-        for ans in all_answers:
-            final_response.answer.append(ans)
-        CACHE[(original_target, original_qtype)] = final_response
-        return final_response
+        if not found_cname:
+            break
     
-    # Too many CNAMEs in chain
-    query = dns.message.make_query(original_target, original_qtype)
-    final_response = dns.message.make_response(query)
-    for ans in all_answers:
-        final_response.answer.append(ans)
-    CACHE[(original_target, original_qtype)] = final_response
-    return final_response
+    # Build the final response with all accumulated answers. With no answers
+    # at all, pass on the (negative) response we got, if any.
+    if all_answers or response is None:
+        result = _build_final(original_target, original_qtype, all_answers)
+        if response is None:
+            # No server answered before the deadline. SERVFAIL tells callers
+            # this says nothing about the name, and keeps it out of the cache.
+            result.set_rcode(dns.rcode.SERVFAIL)
+    else:
+        result = response
+    _cache_put(cache_key, result)
+    return result
 
 def print_results(results: dict) -> None:
     """
@@ -328,9 +761,26 @@ def print_results(results: dict) -> None:
     program would.
     """
 
-    for rtype, fmt_str in FORMATS:
-        for result in results.get(rtype, []):
-            print(fmt_str.format(**result))
+    for rtype, formatter in FORMATTERS:
+        for result in results.get(rtype, ()):
+            print(formatter(result))
+
+
+async def _resolve_all(names: list, verbose: bool) -> None:
+    """
+    Resolve `names` one after another, so each name can reuse the delegations
+    cached while resolving the ones before it. A name that fails to resolve
+    prints nothing and doesn't stop the names after it.
+    """
+    for a_domain_name in names:
+        domain_start = time.time()
+        try:
+            results = await collect_results(a_domain_name)
+        except Exception:
+            results = {}
+        print_results(results)
+        if verbose:
+            print(f"[Time for {a_domain_name}: {time.time() - domain_start:.3f}s]")
 
 
 def main():
@@ -346,19 +796,15 @@ def main():
                                  action="store_true")
     program_args = argument_parser.parse_args()
     
+    _load_caches()
+    atexit.register(_save_caches)
+
     start_time = time.time()
-    for a_domain_name in program_args.name:
-        # Clear RESOLVING set for each new domain to avoid blocking legitimate lookups
-        RESOLVING.clear()
-        domain_start = time.time()
-        print_results(collect_results(a_domain_name))
-        domain_end = time.time()
-        if program_args.verbose:
-            print(f"[Time for {a_domain_name}: {domain_end - domain_start:.3f}s]")
+    asyncio.run(_resolve_all(program_args.name, program_args.verbose))
     
     total_time = time.time() - start_time
     if program_args.verbose:
         print(f"[Total execution time: {total_time:.3f}s]")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()